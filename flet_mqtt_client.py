@@ -17,6 +17,31 @@ import asyncio
 from typing import Any, Callable, Optional
 from dataclasses import dataclass, field
 
+# --- JSON ---
+# orjson is optional; it encodes straight to bytes and is several times faster than the stdlib.
+try:
+    import orjson
+
+    def json_dumps(obj: Any) -> bytes:
+        """Serializes obj to JSON bytes."""
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    json_loads = orjson.loads
+except ImportError:
+    def json_dumps(obj: Any) -> bytes:
+        """Serializes obj to JSON bytes."""
+        return json.dumps(obj).encode()
+
+    json_loads = json.loads
+
+# --- Logging ---
+_LOGGER = logging.getLogger(__name__)
+if not _LOGGER.handlers:
+    _LOGGER.setLevel(logging.INFO)
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    _LOGGER.addHandler(_handler)
+
 # --- Configuration ---
 @dataclass
 class MQTTConfig:
@@ -25,10 +50,14 @@ class MQTTConfig:
     broker_port: int = 1883
     broker_user: Optional[str] = None
     broker_password: Optional[str] = None
-    client_id: str = f'flet_mqtt_async_{socket.gethostname()}_{datetime.now().strftime("%Y%m%d_%H%M%S")}'
+    client_id: str = field(
+        default_factory=lambda: f'flet_mqtt_async_{socket.gethostname()}_{datetime.now().strftime("%Y%m%d_%H%M%S_%f")}'
+    )
     keepalive: int = 60
     qos: int = 0
     subscribe_topics: list[str] = field(default_factory=list)
+    # Retained publishes to the same topic within this many seconds collapse to the latest payload; 0 disables
+    publish_coalesce_window: float = 0.005
 
 # --- Flet MQTT Client Class (Async) ---
 class FletMQTTClient:
@@ -54,9 +83,20 @@ class FletMQTTClient:
         self.page = page
         self.config = config
         self.client = paho.Client(client_id=self.config.client_id)
-        self.logger = self._setup_logging()
-        self.connected_event = asyncio.Event()
+        self.logger = _LOGGER
+        self._connected = False
+        self._connect_future: Optional[asyncio.Future] = None
         self._is_running = False
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._sock_fd: Optional[int] = None
+        self._writer_registered = False
+        self._polling = False
+        self._wakeup_event = asyncio.Event()
+        self._inbox: asyncio.Queue = asyncio.Queue(maxsize=128)
+        self._consumer_future = None
+        self._pub_queue: dict[tuple[str, int, bool], Any] = {}
+        self._pub_event = asyncio.Event()
+        self._flush_future = None
 
         if on_message_handler:
             self.on_message_handler = on_message_handler
@@ -65,61 +105,167 @@ class FletMQTTClient:
 
         self._setup_callbacks()
 
-    def _setup_logging(self) -> logging.Logger:
-        """Configures logging for the client."""
-        logger = logging.getLogger(__name__)
-        if not logger.handlers:
-            logger.setLevel(logging.INFO)
-            handler = logging.StreamHandler(sys.stdout)
-            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-            handler.setFormatter(formatter)
-            logger.addHandler(handler)
-        return logger
-
     def _setup_callbacks(self) -> None:
         """Sets up the Paho MQTT client callbacks."""
         self.client.on_connect = self._on_connect
         self.client.on_message = self._on_message_internal
         self.client.on_disconnect = self._on_disconnect
+        self.client.on_socket_close = self._on_socket_close
         if self.config.broker_user and self.config.broker_password:
             self.client.username_pw_set(self.config.broker_user, self.config.broker_password)
 
     def _on_connect(self, client: paho.Client, userdata: Any, flags: dict, rc: int) -> None:
         """Callback for when the client connects to the broker."""
         if rc == 0:
-            self.logger.info(f"Successfully connected to MQTT broker at {self.config.broker_host}")
-            self.connected_event.set()
+            self.logger.info("Successfully connected to MQTT broker at %s", self.config.broker_host)
+            self._connected = True
+            # Paho callbacks run on the event loop thread, so the future can be resolved directly.
+            if self._connect_future is not None and not self._connect_future.done():
+                self._connect_future.set_result(None)
             if self.config.subscribe_topics:
-                for topic in self.config.subscribe_topics:
-                    client.subscribe(topic, qos=self.config.qos)
-                    self.logger.info(f"Subscribed to topic: {topic}")
+                # A single SUBSCRIBE packet covers all topics.
+                client.subscribe([(topic, self.config.qos) for topic in self.config.subscribe_topics])
+                self.logger.info("Subscribed to topics: %s", self.config.subscribe_topics)
         else:
-            self.logger.error(f"Failed to connect to broker with result code {rc}")
-            self.connected_event.clear()
+            self.logger.error("Failed to connect to broker with result code %s", rc)
+            self._connected = False
 
     def _on_message_internal(self, client: paho.Client, userdata: Any, msg: paho.MQTTMessage) -> None:
-        """Internal callback to pass messages to the handler."""
-        self.logger.info(f"Message received on topic '{msg.topic}': {msg.payload.decode()}")
+        """Internal callback to queue messages for the handler without blocking network I/O."""
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info("Message received on topic '%s': %s", msg.topic, msg.payload.decode(errors="replace"))
         try:
-            self.on_message_handler(msg)
-        except Exception as e:
-            self.logger.error(f"Error processing message in handler: {e}")
+            self._inbox.put_nowait(msg)
+        except asyncio.QueueFull:
+            self.logger.warning("Message queue full, dropping message on topic '%s'", msg.topic)
+
+    async def _consume(self):
+        """
+        The background task that passes queued messages to the handler.
+
+        Handlers are expected to catch the errors they anticipate (e.g. malformed
+        payloads); anything else is a bug, logged with its traceback without
+        stopping the delivery of later messages.
+        """
+        while True:
+            msg = await self._inbox.get()
+            try:
+                self.on_message_handler(msg)
+            except Exception:
+                self.logger.exception("Unhandled error in message handler for topic '%s'", msg.topic)
 
     def _on_disconnect(self, client: paho.Client, userdata: Any, rc: int) -> None:
         """Callback for when the client disconnects."""
-        self.connected_event.clear()
+        self._connected = False
         if rc != 0:
             self.logger.warning("Unexpected disconnection from MQTT broker.")
 
-    async def _background_loop(self):
-        """The background task that runs the MQTT client loop."""
+    def _on_socket_close(self, client: paho.Client, userdata: Any, sock: Any) -> None:
+        """Callback for just before Paho closes the socket, so the event loop stops watching it."""
+        self._unregister_socket()
+
+    def _register_socket(self) -> None:
+        """Registers the Paho socket with the asyncio event loop for readiness notifications."""
+        sock = self.client.socket()
+        if sock is None:
+            return
+        self._tune_socket(sock)
+        try:
+            self._loop.add_reader(sock.fileno(), self._on_socket_readable)
+        except NotImplementedError:
+            # e.g. the default ProactorEventLoop on Windows has no readiness callbacks.
+            self.logger.info("Event loop does not support add_reader; polling the MQTT socket instead.")
+            self._polling = True
+            return
+        self._polling = False
+        self._sock_fd = sock.fileno()
+        self._update_writer()
+        self._wakeup_event.set()
+
+    def _tune_socket(self, sock: Any) -> None:
+        """Disables Nagle's algorithm so small publishes are sent immediately, and enlarges the socket buffers."""
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 64 * 1024)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 64 * 1024)
+        except (AttributeError, OSError) as e:
+            # WebSocket transports wrap the socket and don't expose setsockopt.
+            self.logger.warning("Could not tune MQTT socket options: %s", e)
+
+    def _unregister_socket(self) -> None:
+        """Removes the Paho socket from the asyncio event loop."""
+        if self._sock_fd is None or self._loop is None:
+            return
+        self._loop.remove_reader(self._sock_fd)
+        if self._writer_registered:
+            self._loop.remove_writer(self._sock_fd)
+            self._writer_registered = False
+        self._sock_fd = None
+
+    def _update_writer(self) -> None:
+        """Watches the socket for writability only while Paho has outgoing data queued."""
+        if self._sock_fd is None:
+            return
+        if self.client.want_write():
+            if not self._writer_registered:
+                self._loop.add_writer(self._sock_fd, self._on_socket_writable)
+                self._writer_registered = True
+        elif self._writer_registered:
+            self._loop.remove_writer(self._sock_fd)
+            self._writer_registered = False
+
+    def _on_socket_readable(self) -> None:
+        """Event loop callback for when the socket has incoming data."""
+        self.client.loop_read()
+        self._update_writer()
+
+    def _on_socket_writable(self) -> None:
+        """Event loop callback for when the socket can accept outgoing data."""
+        self.client.loop_write()
+        self._update_writer()
+
+    def _next_misc_timeout(self) -> Optional[float]:
+        """Returns the seconds until Paho's next keepalive deadline, or None if there is none."""
+        if self.config.keepalive <= 0 or self.client.socket() is None:
+            return None
+        # Never sleep longer than keepalive/2, so pings still go out if the private timestamps
+        # read below change meaning or disappear in a future Paho release.
+        max_timeout = self.config.keepalive / 2
+        # Paho tracks these timestamps with its own time_func but exposes no public accessor.
+        ping_t = getattr(self.client, '_ping_t', None)
+        last_msg_in = getattr(self.client, '_last_msg_in', None)
+        last_msg_out = getattr(self.client, '_last_msg_out', None)
+        if ping_t is None or last_msg_in is None or last_msg_out is None:
+            return max_timeout
+        if ping_t:
+            deadline = ping_t + self.config.keepalive
+        else:
+            deadline = min(last_msg_in, last_msg_out) + self.config.keepalive
+        return min(max(deadline - paho.time_func(), 0.0), max_timeout)
+
+    async def _misc_loop(self):
+        """The background task that handles keepalive pings and timeouts."""
         self.logger.info("MQTT background loop started.")
         while self._is_running:
-            # loop() is a non-blocking call that processes network events.
-            self.client.loop()
-            await asyncio.sleep(0.1) # Sleep briefly to yield control
+            self._wakeup_event.clear()
+            try:
+                await asyncio.wait_for(self._wakeup_event.wait(), timeout=self._next_misc_timeout())
+                continue
+            except asyncio.TimeoutError:
+                pass
+            self.client.loop_misc()
+            self._update_writer()
         self.logger.info("MQTT background loop stopped.")
 
+    async def _poll_loop(self):
+        """Fallback background task that polls the MQTT client loop on event loops without add_reader."""
+        self.logger.info("MQTT polling loop started.")
+        while self._is_running:
+            # loop() is a non-blocking call that processes network events.
+            self.client.loop(timeout=0)
+            await asyncio.sleep(0.1)
+        self.logger.info("MQTT polling loop stopped.")
+
     async def start(self) -> None:
         """Connects to the broker and starts the non-blocking background task."""
         if self._is_running:
@@ -127,14 +273,34 @@ class FletMQTTClient:
             return
         try:
             self.logger.info("Starting MQTT client...")
-            self.connected_event.clear()
-            self.client.connect(self.config.broker_host, self.config.broker_port, self.config.keepalive)
+            self._connected = False
+            self._loop = asyncio.get_running_loop()
+            # connect() resolves the host and opens the TCP connection synchronously,
+            # so run it in a worker thread to keep the UI event loop responsive.
+            if self.client.host:
+                # The client has connected before, so reuse its stored connection settings.
+                await self._loop.run_in_executor(None, self.client.reconnect)
+            else:
+                await self._loop.run_in_executor(
+                    None, self.client.connect, self.config.broker_host, self.config.broker_port, self.config.keepalive
+                )
+            self._register_socket()
             self._is_running = True
-            await self.page.run_task(self._background_loop)
+            self.page.run_task(self._poll_loop if self._polling else self._misc_loop)
+            self._consumer_future = self.page.run_task(self._consume)
+            self._flush_future = self.page.run_task(self._flush_loop)
         except (socket.error, OSError) as e:
-            self.logger.error(f"Could not connect to MQTT broker at {self.config.broker_host}: {e}")
+            self.logger.error("Could not connect to MQTT broker at %s: %s", self.config.broker_host, e)
+            self._close_failed_start()
         except Exception as e:
-            self.logger.error(f"An unexpected error occurred while starting the client: {e}")
+            self.logger.exception("An unexpected error occurred while starting the client: %r", e)
+            self._close_failed_start()
+
+    def _close_failed_start(self) -> None:
+        """Closes a connection left open when start() fails after connecting."""
+        self._unregister_socket()
+        if self.client.socket() is not None:
+            self.client.disconnect()
 
     async def stop(self) -> None:
         """Stops the background task and disconnects gracefully."""
@@ -142,30 +308,117 @@ class FletMQTTClient:
             return
         self.logger.info("Stopping MQTT client...")
         self._is_running = False
+        self._wakeup_event.set()
+        if self._consumer_future is not None:
+            self._consumer_future.cancel()
+            self._consumer_future = None
+        # Drop messages from this session so a later start() doesn't replay stale state.
+        while True:
+            try:
+                self._inbox.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+        if self._flush_future is not None:
+            self._flush_future.cancel()
+            self._flush_future = None
+        # Send anything still waiting in the coalescing window before disconnecting.
+        self._flush_publishes()
+        self._unregister_socket()
         self.client.disconnect()
-        self.connected_event.clear()
+        self._connected = False
 
     async def publish(self, topic: str, payload: Any, qos: Optional[int] = None, retain: bool = False) -> None:
         """
         Publishes a message to a given topic, waiting for a connection first.
+
+        Retained messages are state, so they are sent after config.publish_coalesce_window
+        and repeated retained publishes to the same topic within that window only send
+        the latest payload. All other messages are sent immediately, in order.
         """
-        try:
-            await asyncio.wait_for(self.connected_event.wait(), timeout=5.0)
-        except asyncio.TimeoutError:
-            self.logger.error("Publish failed: MQTT client is not connected.")
-            return
+        if not self._connected:
+            # All waiters share one future, resolved by _on_connect.
+            if self._connect_future is None or self._connect_future.done():
+                self._connect_future = asyncio.get_running_loop().create_future()
+            try:
+                await asyncio.wait_for(asyncio.shield(self._connect_future), timeout=5.0)
+            except asyncio.TimeoutError:
+                self.logger.error("Publish failed: MQTT client is not connected.")
+                return
 
+        # Pre-encoded bytes are sent as-is.
         if isinstance(payload, (dict, list)):
-            payload = json.dumps(payload)
+            payload = json_dumps(payload)
             
         qos_level = qos if qos is not None else self.config.qos
-        
-        result = self.client.publish(topic, payload, qos=qos_level, retain=retain)
+        # Validate up front so errors reach the caller rather than the background flush task.
+        self._validate_publish(topic, payload, qos_level)
+
+        if not retain or self.config.publish_coalesce_window <= 0:
+            # Send any queued state first so messages reach the broker in publish order.
+            self._flush_publishes()
+            self._publish_now(topic, payload, qos_level, retain)
+            return
+
+        # Last value wins: a newer payload for the same key replaces one not yet sent,
+        # and moves to the back so the queue stays in order of the latest publishes.
+        key = (topic, qos_level, retain)
+        self._pub_queue.pop(key, None)
+        self._pub_queue[key] = payload
+        self._pub_event.set()
+
+    @staticmethod
+    def _validate_publish(topic: str, payload: Any, qos: int) -> None:
+        """Raises the same ValueError/TypeError Paho's publish() would for an invalid publish (MQTT v3.1.1)."""
+        if not topic:
+            raise ValueError('Invalid topic.')
+        topic_bytes = topic.encode('utf-8')
+        if b'+' in topic_bytes or b'#' in topic_bytes:
+            raise ValueError('Publish topic cannot contain wildcards.')
+        if len(topic_bytes) > 65535:
+            raise ValueError('Publish topic is too long.')
+        if qos not in (0, 1, 2):
+            raise ValueError('Invalid QoS level.')
+        if isinstance(payload, str):
+            payload_len = len(payload.encode('utf-8'))
+        elif isinstance(payload, (int, float)):
+            payload_len = len(str(payload))
+        elif payload is None:
+            payload_len = 0
+        elif isinstance(payload, (bytes, bytearray)):
+            payload_len = len(payload)
+        else:
+            raise TypeError('payload must be a string, bytearray, int, float or None.')
+        if payload_len > 268435455:
+            raise ValueError('Payload too large.')
+
+    def _publish_now(self, topic: str, payload: Any, qos: int, retain: bool) -> None:
+        """Hands a single message to Paho for sending."""
+        result = self.client.publish(topic, payload, qos=qos, retain=retain)
+        self._update_writer()
         
         if result.rc == paho.MQTT_ERR_SUCCESS:
-            self.logger.info(f"Queued publish to topic '{topic}': {payload}")
+            if self.logger.isEnabledFor(logging.INFO):
+                self.logger.info("Queued publish to topic '%s': %s", topic, payload)
         else:
-            self.logger.error(f"Failed to queue publish to topic '{topic}'")
+            self.logger.error("Failed to queue publish to topic '%s'", topic)
+
+    def _flush_publishes(self) -> None:
+        """Sends every coalesced message waiting in the publish queue."""
+        pending, self._pub_queue = self._pub_queue, {}
+        for (topic, qos, retain), payload in pending.items():
+            # One bad message must not stop the rest of the queue from being sent.
+            try:
+                self._publish_now(topic, payload, qos, retain)
+            except (ValueError, TypeError) as e:
+                self.logger.error("Failed to publish to topic '%s': %s", topic, e)
+
+    async def _flush_loop(self):
+        """The background task that flushes the publish queue once per coalescing window."""
+        while True:
+            await self._pub_event.wait()
+            await asyncio.sleep(self.config.publish_coalesce_window)
+            self._pub_event.clear()
+            self._flush_publishes()
 
     def on_message(self, msg: paho.MQTTMessage) -> None:
         """Placeholder message handler, intended to be overridden by a subclass."""
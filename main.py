@@ -1,9 +1,7 @@
 import flet as ft
-from flet_mqtt_client import FletMQTTClient, MQTTConfig
-import json
+from flet_mqtt_client import FletMQTTClient, MQTTConfig, json_loads
 import time
 import asyncio
-from datetime import datetime
 
 # --- Constants for the Example ---
 # You can use a public broker like 'broker.hivemq.com' for testing
@@ -12,6 +10,13 @@ BROKER_HOST = "broker.hivemq.com"
 BASE_TOPIC = f"flet-mqtt-demo/user/{time.time_ns()}"
 STATE_TOPIC = f"{BASE_TOPIC}/light/state"
 COMMAND_TOPIC = f"{BASE_TOPIC}/light/set"
+# Pre-encoded command payloads, published as-is
+PAYLOAD_ON = b'{"state": "ON"}'
+PAYLOAD_OFF = b'{"state": "OFF"}'
+
+# --- Static UI Values ---
+PAGE_TITLE = "Flet MQTT Light Control (Async)"
+BROKER_INFO = f"Topic: {STATE_TOPIC}"
 
 
 class LightControlApp(FletMQTTClient):
@@ -28,17 +33,28 @@ class LightControlApp(FletMQTTClient):
             config: The MQTT configuration.
         """
         super().__init__(page, config)
+        # Known payloads map straight to a state, skipping the JSON parse
+        self._payload_table = {
+            PAYLOAD_ON: "ON",
+            b'{"state":"ON"}': "ON",
+            PAYLOAD_OFF: "OFF",
+            b'{"state":"OFF"}': "OFF",
+        }
+        self._update_pending = False
+        self._update_delay = 0.016  # One UI frame at 60 fps
+        self._last_second = 0
+        self._last_timestr = ''
         self._setup_ui()
 
     def _setup_ui(self):
         """Sets up the Flet user interface components."""
-        self.page.title = "Flet MQTT Light Control (Async)"
+        self.page.title = PAGE_TITLE
         self.page.vertical_alignment = ft.MainAxisAlignment.CENTER
         
         self.light_icon = ft.Icon(name=ft.Icons.LIGHTBULB_OUTLINE, size=100, color=ft.Colors.GREY)
         self.status_text = ft.Text("Waiting for status...", size=24, weight=ft.FontWeight.BOLD)
         self.last_updated_text = ft.Text("Never", italic=True, color=ft.Colors.GREY_600)
-        self.broker_info_text = ft.Text(f"Topic: {STATE_TOPIC}", size=12, selectable=True, text_align=ft.TextAlign.CENTER)
+        self.broker_info_text = ft.Text(BROKER_INFO, size=12, selectable=True, text_align=ft.TextAlign.CENTER)
 
         self.toggle_button = ft.ElevatedButton(
             text="Toggle Light",
@@ -62,21 +78,28 @@ class LightControlApp(FletMQTTClient):
                 spacing=20
             )
         )
-        self.page.update()
 
     def on_message(self, msg: 'paho.mqtt.client.MQTTMessage'):
         """
         Overrides the parent method to handle incoming MQTT messages.
-        This method is called from the background MQTT loop.
+        This method is called from the background message consumer task.
         """
-        try:
-            payload = json.loads(msg.payload.decode())
-            if 'state' in payload:
-                self.update_ui(payload['state'])
-        except json.JSONDecodeError:
-            self.logger.error(f"Could not decode JSON payload: {msg.payload.decode()}")
-        except Exception as e:
-            self.logger.error(f"Error updating UI from message: {e}")
+        state = self._payload_table.get(msg.payload)
+        if state is None:
+            try:
+                # json_loads accepts bytes directly, saving an intermediate str.
+                payload = json_loads(msg.payload)
+            except ValueError:
+                # Covers JSONDecodeError (stdlib and orjson) and UnicodeDecodeError for non-UTF-8 bytes
+                self.logger.error("Could not decode JSON payload: %r", msg.payload)
+                return
+            if not isinstance(payload, dict) or 'state' not in payload:
+                return
+            state = payload['state']
+            if not isinstance(state, str):
+                self.logger.error("Unexpected payload %r: state is not a string", msg.payload)
+                return
+        self.update_ui(state)
 
     def update_ui(self, state: str):
         """Safely updates the Flet UI based on the received state."""
@@ -89,10 +112,27 @@ class LightControlApp(FletMQTTClient):
             self.light_icon.color = ft.Colors.GREY
             self.status_text.value = "OFF"
             
-        self.last_updated_text.value = f"Last update: {datetime.now().strftime('%H:%M:%S')}"
+        # Only reformat the timestamp when the wall-clock second changes
+        sec = int(time.time())
+        if sec != self._last_second:
+            self._last_second = sec
+            self._last_timestr = time.strftime('%H:%M:%S', time.localtime(sec))
+        self.last_updated_text.value = f"Last update: {self._last_timestr}"
         self.toggle_button.disabled = False
         
-        # self.page.update() must be called to render the changes
+        # Changes are rendered by a page.update() deferred to the end of the current frame
+        self._schedule_update()
+
+    def _schedule_update(self):
+        """Coalesces bursts of UI changes into a single page.update() per frame."""
+        if self._update_pending:
+            return
+        self._update_pending = True
+        asyncio.get_running_loop().call_later(self._update_delay, self._flush_update)
+
+    def _flush_update(self):
+        """Renders all pending UI changes."""
+        self._update_pending = False
         self.page.update()
 
     async def toggle_light_state_async(self, e: ft.ControlEvent):
@@ -100,11 +140,12 @@ class LightControlApp(FletMQTTClient):
         current_state = self.status_text.value
         new_state = "OFF" if current_state == "ON" else "ON"
         
-        self.logger.info(f"Publishing new state: {new_state}")
+        self.logger.info("Publishing new state: %s", new_state)
         # The publish method is a coroutine and should be awaited.
+        # Payloads are pre-encoded, so publish sends the bytes as-is.
         await self.publish(
             topic=COMMAND_TOPIC,
-            payload={"state": new_state}
+            payload=PAYLOAD_ON if new_state == "ON" else PAYLOAD_OFF
         )
 
 async def main(page: ft.Page):
@@ -130,7 +171,7 @@ async def main(page: ft.Page):
     await app.start()
     
     # Initially publish an OFF state to get things started.
-    await app.publish(STATE_TOPIC, {"state": "OFF"}, retain=True)
+    await app.publish(STATE_TOPIC, PAYLOAD_OFF, retain=True)
 
 if __name__ == "__main__":
     ft.app(target=main)